@@ -1,51 +1,336 @@
+import collections
+import ctypes
+import math
 import types
 import typing
 from .kbnf import InternalEngine, AcceptTokenResult
-_slice_converters = []
+# Bound once at import so each call skips building a `super()` proxy and its method lookup.
+_internal_mask_logits = InternalEngine.mask_logits
+_internal_update_logits = InternalEngine.update_logits
+_slice_converters:typing.List[typing.Tuple[type,typing.Callable[[typing.Any],typing.Tuple[typing.Any,int,int]]]] = []
+_MAX_CACHE_SIZE = 4096
+# The default of Engine.mask_cache_capacity_in_bytes. The cache belongs to each engine,
+# and an engine is usually created per sequence, so the default is kept small.
+_DEFAULT_MASK_CACHE_CAPACITY_IN_BYTES = 1 << 20
+# The torch fast path masks with a packed bitmask once both the allowed and the disallowed token IDs
+# exceed vocab_size >> _BITMASK_THRESHOLD_SHIFT, and with the smaller index set otherwise.
+_BITMASK_THRESHOLD_SHIFT = 3
+# Pinned buffers are allocated in multiples of a 4 KiB page of int64, and each engine pools at most this many bytes of them.
+_PINNED_BUFFER_GRANULARITY = 512
+_MAX_PIN_POOL_SIZE_IN_BYTES = 256 << 10
+# A replayed graph would reuse the masking data captured once, but the allowed token IDs change after every token.
+_GRAPH_CAPTURE_ERROR = "Logits cannot be masked during CUDA graph capture."
+# A predicate telling whether the logits can be masked by the fast path, a predicate telling whether
+# the logits are being captured into a graph, and the fast mask function itself.
+_FastMaskLogits = typing.Tuple[typing.Callable[[typing.Any],bool],
+                               typing.Callable[[typing.Any],bool],
+                               typing.Callable[[InternalEngine,typing.Any],typing.Any]]
+_fast_mask_logits:typing.List[typing.Tuple[type,_FastMaskLogits]] = []
+# Maps a logits type to its fast path (if any) and slice converter, resolved on first use.
+_dispatch_cache:typing.Dict[type,typing.Tuple[typing.Optional[_FastMaskLogits],
+                                              typing.Callable[[typing.Any],typing.Tuple[typing.Any,int,int]]]] = {}
 
-def _try_register_slice_converter(module_name:str,
-                        obtain_converter:typing.Callable[[types.ModuleType],
-                                                        typing.Callable[[typing.Any],
-                                                                        typing.Optional[typing.Tuple[typing.Any,int,int]]]]):
+def _try_register(registry:typing.List[typing.Tuple[type,typing.Any]],
+                  module_name:str,
+                  obtain:typing.Callable[[types.ModuleType],typing.Tuple[type,typing.Any]]):
     try:
         module = __import__(module_name)
-        _slice_converters.append(obtain_converter(module))
+        registry.append(obtain(module))
+        _dispatch_cache.clear()
     except ImportError:
         pass
 
+def _try_register_slice_converter(module_name:str,
+                        obtain_converter:typing.Callable[[types.ModuleType],
+                                                        typing.Tuple[type,
+                                                                     typing.Callable[[typing.Any],
+                                                                                     typing.Tuple[typing.Any,int,int]]]]):
+    _try_register(_slice_converters, module_name, obtain_converter)
+
+def _try_register_fast_mask_logits(module_name:str,
+                        obtain_fast_mask_logits:typing.Callable[[types.ModuleType],
+                                                                typing.Tuple[type,_FastMaskLogits]]):
+    _try_register(_fast_mask_logits, module_name, obtain_fast_mask_logits)
+
 def _torch_slice_converter(module:types.ModuleType):
-    def convert_slice(tensor:typing.Any)->typing.Optional[typing.Tuple[typing.Any,int,int]]:
-        if isinstance(tensor, module.Tensor):
-            assert tensor.dim() == 1 or tensor.dim() == 2 and tensor.shape[0] == 1,\
-            f"Only tensors with shape (n) or (1,n) are supported, while the actual tensor shape is {tensor.shape}"
-            tensor = tensor.to(device="cpu",dtype=module.float32,memory_format=module.contiguous_format)
-            ptr = tensor.data_ptr()
-            assert ptr % 4 == 0, f"The tensor data pointer which points to {ptr} is not aligned to 4 bytes"
-            return tensor, ptr, tensor.shape[-1]
-        return None
-    return convert_slice
+    def convert_slice(tensor:typing.Any)->typing.Tuple[typing.Any,int,int]:
+        assert tensor.dim() == 1 or tensor.dim() == 2 and tensor.shape[0] == 1,\
+        f"Only tensors with shape (n) or (1,n) are supported, while the actual tensor shape is {tensor.shape}"
+        # `is_cpu` avoids constructing a `torch.device` object on every call.
+        # Tensors on other devices are masked there by the fast path, which accepts the same shapes,
+        # so they only reach this copy if the fast path is not registered.
+        if not tensor.is_cpu or tensor.dtype is not module.float32:
+            tensor = tensor.to(device="cpu",dtype=module.float32)
+        if not tensor.is_contiguous():
+            tensor = tensor.contiguous()
+        ptr = tensor.data_ptr()
+        assert ptr % 4 == 0, f"The tensor data pointer which points to {ptr} is not aligned to 4 bytes"
+        return tensor, ptr, tensor.shape[-1]
+    return module.Tensor, convert_slice
 
 def _numpy_slice_converter(module:types.ModuleType):
-    def convert_slice(array:typing.Any)->typing.Optional[typing.Tuple[typing.Any,int,int]]:
-        if isinstance(array, module.ndarray):
-            assert array.ndim == 1 or array.ndim == 2 and array.shape[0] == 1,\
-            f"Only array with shape (n) or (1,n) are supported, while the actual array shape is {array.shape}"
-            if (array.dtype != module.float32 or not array.flags["CARRAY"]):
-                array = array.astype(module.float32, order="C")
-            ptr = array.ctypes.data
-            assert ptr % 4 == 0, f"The tensor data pointer which points to {ptr} is not aligned to 4 bytes"
-            return array, ptr, array.shape[-1]
-        return None
-    return convert_slice
-
-def _convert_logits_to_slice(logits:typing.Any)->typing.Tuple[typing.Any,int,int]:
-    for converter in _slice_converters:
-        converted = converter(logits)
-        if converted is not None:
-            return converted
-    raise TypeError(f"Unsupported type of logits: {type(logits)}")
+    float32 = module.dtype(module.float32)
+    char_from_buffer = ctypes.c_char.from_buffer
+    addressof = ctypes.addressof
+    def convert_slice(array:typing.Any)->typing.Tuple[typing.Any,int,int]:
+        assert array.ndim == 1 or array.ndim == 2 and array.shape[0] == 1,\
+        f"Only array with shape (n) or (1,n) are supported, while the actual array shape is {array.shape}"
+        dtype = array.dtype
+        # Native-endian float32 dtypes are a singleton, so the identity check almost always suffices.
+        if dtype is not float32 and dtype != float32:
+            array = array.astype(module.float32, order="C")
+        else:
+            # A float32 array only needs a plain copy rather than a dtype conversion.
+            flags = array.flags
+            if not flags["C_CONTIGUOUS"]:
+                array = module.ascontiguousarray(array)
+            elif not (flags["ALIGNED"] and flags["WRITEABLE"]):
+                array = array.copy()
+        # The array is writable and contiguous here, so its address can be taken through
+        # the buffer protocol, which is several times cheaper than `array.ctypes.data`.
+        ptr = addressof(char_from_buffer(array)) if array.size else array.ctypes.data
+        assert ptr % 4 == 0, f"The tensor data pointer which points to {ptr} is not aligned to 4 bytes"
+        return array, ptr, array.shape[-1]
+    return module.ndarray, convert_slice
+
+def _torch_fast_mask_logits(module:types.ModuleType):
+    def acquire_pinned_buffer(engine:InternalEngine, length:int)->typing.Any:
+        # Pinning host memory is slow, so released pinned buffers are pooled and the smallest one that fits is reused.
+        pool = engine._pin_pool
+        best = None
+        for i, (buffer, _) in enumerate(pool):
+            if buffer.shape[0] >= length and (best is None or buffer.shape[0] < pool[best][0].shape[0]):
+                best = i
+        if best is not None:
+            buffer, copy_events = pool.pop(best)
+            engine._pin_pool_size_in_bytes -= buffer.nbytes
+            # The copies from its previous use have almost always finished by now.
+            for copy_event in copy_events:
+                copy_event.synchronize()
+            return buffer
+        # Memory is pinned by whole pages, so rounding the length up to a page costs nothing.
+        capacity = -(-length // _PINNED_BUFFER_GRANULARITY) * _PINNED_BUFFER_GRANULARITY
+        return module.empty((capacity,), dtype=module.int64, pin_memory=True)
+
+    def release_pinned_buffer(engine:InternalEngine, buffer:typing.Any, copy_events:typing.List[typing.Any]):
+        # A buffer beyond the pool's budget is dropped instead. PyTorch's pinned memory allocator
+        # does not hand its memory out again before the copies recorded on it have completed.
+        if engine._pin_pool_size_in_bytes + buffer.nbytes > _MAX_PIN_POOL_SIZE_IN_BYTES:
+            return
+        # In-flight copies may still read from the buffer, so they are only waited for once it is reused.
+        engine._pin_pool.append((buffer, copy_events))
+        engine._pin_pool_size_in_bytes += buffer.nbytes
+
+    def copy_to_device(engine:InternalEngine, host:typing.Any, tensor:typing.Any, copy_events:typing.List[typing.Any])->typing.Any:
+        if not tensor.is_cuda:
+            # The copy is synchronous and always made, so the host buffer can be reused right after.
+            return host.to(device=tensor.device, copy=True)
+        # Copy on a side stream so the transfer is not queued behind the model's kernels.
+        copy_stream = engine._copy_streams.get(tensor.device)
+        if copy_stream is None:
+            copy_stream = module.cuda.Stream(device=tensor.device)
+            engine._copy_streams[tensor.device] = copy_stream
+        with module.cuda.stream(copy_stream):
+            copied = host.to(device=tensor.device, non_blocking=True)
+        copy_events.append(copy_stream.record_event())
+        current_stream = module.cuda.current_stream(tensor.device)
+        current_stream.wait_stream(copy_stream)
+        copied.record_stream(current_stream)
+        return copied
+
+    # Bound once here since they are looked up on every call.
+    neg_inf = -math.inf
+    current_stream_of = module.cuda.current_stream
+    is_current_stream_capturing = module.cuda.is_current_stream_capturing
+    # Maps a device to the 64 single-bit int64 values used to unpack bitmasks on it.
+    bits_of_device = {}
+
+    def fill_disallowed(tensor:typing.Any, disallowed:typing.Any)->typing.Any:
+        return tensor.index_fill_(-1, disallowed, neg_inf)
+
+    def keep_allowed(tensor:typing.Any, allowed:typing.Any)->typing.Any:
+        # Masking in place lets the caller keep reusing its logits buffer.
+        # index_select/index_copy_ take the 1-D index as is for both (n) and (1,n) logits,
+        # while gather/scatter_ would need it expanded to the logits' rank first.
+        allowed_logits = tensor.index_select(-1, allowed)
+        tensor.fill_(neg_inf)
+        return tensor.index_copy_(-1, allowed, allowed_logits)
+
+    def fill_masked(tensor:typing.Any, disallowed_mask:typing.Any)->typing.Any:
+        return tensor.masked_fill_(disallowed_mask, neg_inf)
+
+    def fill_all(tensor:typing.Any, _:typing.Any)->typing.Any:
+        return tensor.fill_(neg_inf)
+
+    def is_capturing_graph(tensor:typing.Any)->bool:
+        return tensor.is_cuda and is_current_stream_capturing()
+
+    def can_mask_on_device(tensor:typing.Any)->bool:
+        if tensor.is_cpu:
+            return False
+        # Other dtypes cannot hold negative infinity, and autograd rejects in-place updates of a leaf
+        # that requires grad, so both are converted to CPU float32 copies instead.
+        if not tensor.is_floating_point() or tensor.requires_grad and tensor.is_leaf:
+            return False
+        shape = tensor.shape
+        # Masking on the tensor's own device avoids copying the whole logits to CPU and back.
+        return len(shape) == 1 or len(shape) == 2 and shape[0] == 1
+
+    def unpack_bitmask(words:typing.Any, vocab_size:int)->typing.Any:
+        # Testing each word against the 64 single-bit values needs no shift and only one temporary.
+        device = words.device
+        bits = bits_of_device.get(device)
+        if bits is None:
+            bits = module.ones(1, dtype=module.int64, device=device) << module.arange(64, dtype=module.int64, device=device)
+            bits_of_device[device] = bits
+        return ((words.unsqueeze(-1) & bits) == 0).view(-1)[:vocab_size]
+
+    def mask_logits_fast(engine:InternalEngine, tensor:typing.Any)->typing.Any:
+        shape = tensor.shape
+        device = tensor.device
+        cache = engine._cache
+        # A 64-bit fingerprint hashes in constant time, and a collision among the at most
+        # _MAX_CACHE_SIZE live entries is far less likely than a hardware memory error.
+        fingerprint = engine.get_fingerprint_of_allowed_token_ids()
+        entry = cache.get(fingerprint)
+        if entry is None:
+            entry = create_entry(engine, tensor)
+            cache[fingerprint] = entry
+            engine._cache_size_in_bytes += sum(data.nbytes for data in entry[2].values())
+            _shrink_mask_cache(engine)
+            # A new entry already matches the vocabulary size and holds the data for this device.
+            _, apply_mask, device_data = entry
+            return tensor if apply_mask is None else apply_mask(tensor, device_data.get(device))
+        cache.move_to_end(fingerprint)
+        vocab_size, apply_mask, device_data = entry
+        if vocab_size != shape[-1]:
+            raise ValueError("The input logits array is not equal to the vocabulary size.")
+        if apply_mask is None:
+            return tensor
+        data = device_data.get(device)
+        if data is None:
+            if not device_data:
+                return apply_mask(tensor, None)
+            # No host copy is kept, so the data is copied over from another device.
+            data = next(iter(device_data.values())).to(device=device)
+            device_data[device] = data
+            engine._cache_size_in_bytes += data.nbytes
+            _shrink_mask_cache(engine)
+        elif tensor.is_cuda:
+            # The caching allocator must know every stream that reads the data
+            # before it may reuse the memory after eviction.
+            data.record_stream(current_stream_of(device))
+        return apply_mask(tensor, data)
+
+    def create_entry(engine:InternalEngine, tensor:typing.Any)->typing.Tuple[int,typing.Any,dict]:
+        # The masking strategy is chosen once per allowed set, so cache hits only replay it.
+        vocab_size = tensor.shape[-1]
+        num_of_allowed, num_of_disallowed = engine.get_number_of_allowed_and_disallowed_token_ids()
+        if num_of_allowed + num_of_disallowed != vocab_size:
+            raise ValueError("The input logits array is not equal to the vocabulary size.")
+        # Neither extreme needs any token IDs, so no buffer is written for them.
+        if num_of_disallowed == 0:
+            return (vocab_size, None, {})
+        if num_of_allowed == 0:
+            return (vocab_size, fill_all, {})
+        # When both sets are large, a packed bitmask is much smaller than either index tensor.
+        use_bitmask = min(num_of_allowed, num_of_disallowed) > vocab_size >> _BITMASK_THRESHOLD_SHIFT
+        # The allowed and disallowed token IDs partition the vocabulary, so one scratch buffer
+        # of the vocabulary size holds both and is filled in a single call.
+        # It is reused across entries, which only keep a device copy of the part they mask with.
+        # int64 has a fixed width and pointers cross the FFI as `usize`,
+        # so the buffers work the same under 32-bit and 64-bit interpreters.
+        scratch = engine._scratch_buffer
+        if scratch is None or scratch.shape[0] < vocab_size:
+            scratch = module.empty((vocab_size,), dtype=module.int64)
+            engine._scratch_buffer = scratch
+        if use_bitmask:
+            # The bitmask needs ceil(vocab_size/64) int64 words.
+            engine.write_bitmask_to_buffer(scratch.data_ptr(), vocab_size)
+            apply_mask, kept = fill_masked, scratch[:(vocab_size + 63) >> 6]
+        else:
+            engine.write_allowed_and_disallowed_token_ids_to_buffer(scratch.data_ptr(), vocab_size)
+            # Index whichever side is smaller.
+            if num_of_allowed < num_of_disallowed:
+                apply_mask, kept = keep_allowed, scratch[:num_of_allowed]
+            else:
+                apply_mask, kept = fill_disallowed, scratch[num_of_allowed:vocab_size]
+        if tensor.is_cuda:
+            length = kept.shape[0]
+            pinned_buffer = acquire_pinned_buffer(engine, length)
+            host = pinned_buffer[:length]
+            host.copy_(kept)
+            copy_events = []
+            data = copy_to_device(engine, host, tensor, copy_events)
+            # The buffer returns to the pool right away and is only reused once the copy has completed.
+            release_pinned_buffer(engine, pinned_buffer, copy_events)
+        else:
+            data = copy_to_device(engine, kept, tensor, [])
+        if use_bitmask:
+            data = unpack_bitmask(data, vocab_size)
+        return (vocab_size, apply_mask, {tensor.device: data})
+    return module.Tensor, (can_mask_on_device, is_capturing_graph, mask_logits_fast)
+
+def _shrink_mask_cache(engine:InternalEngine):
+    cache = engine._cache
+    # The most recently used entry is kept even if it alone exceeds the capacity.
+    while len(cache) > 1 and (len(cache) > _MAX_CACHE_SIZE
+                              or engine._cache_size_in_bytes > engine._cache_capacity_in_bytes):
+        _, (_, _, device_data) = cache.popitem(last=False)
+        engine._cache_size_in_bytes -= sum(data.nbytes for data in device_data.values())
+
+def _find_registered(registry:typing.List[typing.Tuple[type,typing.Any]], logits_type:type)->typing.Any:
+    # Subclasses like torch.nn.Parameter are matched as well.
+    for registered_type, handler in registry:
+        if issubclass(logits_type, registered_type):
+            return handler
+    return None
+
+def _resolve_dispatch(logits_type:type)->typing.Tuple[typing.Optional[_FastMaskLogits],
+                                                      typing.Callable[[typing.Any],typing.Tuple[typing.Any,int,int]]]:
+    converter = _find_registered(_slice_converters, logits_type)
+    if converter is None:
+        raise TypeError(f"Unsupported type of logits: {logits_type}")
+    dispatch = (_find_registered(_fast_mask_logits, logits_type), converter)
+    _dispatch_cache[logits_type] = dispatch
+    return dispatch
 
 class Engine(InternalEngine):
+    def __init__(self, *args, **kwargs):
+        # Maps the fingerprint of allowed token IDs to the vocabulary size, the mask function and the masking data
+        # on each device, evicting the least recently used entries when full.
+        self._cache = collections.OrderedDict()
+        # The bytes of masking data held by the cache across all devices.
+        self._cache_size_in_bytes = 0
+        self._cache_capacity_in_bytes = _DEFAULT_MASK_CACHE_CAPACITY_IN_BYTES
+        # Maps a CUDA device to the side stream used to copy indices to it.
+        self._copy_streams = {}
+        # The int64 buffer the engine writes token IDs or bitmasks to, grown to the largest vocabulary seen.
+        self._scratch_buffer = None
+        # Released pinned int64 buffers, each with the events of the copies that may still read from it.
+        self._pin_pool = []
+        self._pin_pool_size_in_bytes = 0
+
+    @property
+    def mask_cache_capacity_in_bytes(self)->int:
+        """
+The maximum number of bytes of masking data cached on devices for `torch.Tensor` logits that are not on CPU.
+The least recently used entries are evicted once the cache exceeds it,
+except the most recently used entry which is always kept. Defaults to 1 MiB.
+
+The limit applies to this engine alone, so the device memory held by all caches grows with the number of live engines.
+Besides the cache, each engine that masks such logits keeps a host int64 buffer of the vocabulary size
+and up to 256 KiB of pinned host memory.
+        """
+        return self._cache_capacity_in_bytes
+
+    @mask_cache_capacity_in_bytes.setter
+    def mask_cache_capacity_in_bytes(self, capacity:int):
+        if capacity < 0:
+            raise ValueError(f"The mask cache capacity should be non-negative, while the actual capacity is {capacity}.")
+        self._cache_capacity_in_bytes = capacity
+        _shrink_mask_cache(self)
+
     def mask_logits(self, logits):
         """
 Masks the logits based on last computed token IDs.
@@ -63,6 +348,8 @@ The logits will be updated in-place if:
     * The logits data type is `float32`.
     * The underlying data buffer are contiguous AND on CPU.
     * The data pointer is aligned to 4 bytes.
+A `torch.Tensor` that is not on CPU is masked in-place on its own device instead,
+which is not allowed during CUDA graph capture.
 
 # Returns
 
@@ -70,8 +357,19 @@ The masked logits. The shape of the returned logits is the same as the input log
 The returned logits is the same object as the input logits if the input logits is updated in-place.
 Otherwise, a new object with the same type as the input logits is returned.
         """
-        logits, ptr, size = _convert_logits_to_slice(logits)
-        super().mask_logits(ptr, size)
+        # One lookup yields both handlers, so each call pays for a single dict access.
+        dispatch = _dispatch_cache.get(type(logits))
+        if dispatch is None:
+            dispatch = _resolve_dispatch(type(logits))
+        fast_path, convert_slice = dispatch
+        if fast_path is not None:
+            can_mask_fast, is_capturing_graph, mask_logits_fast = fast_path
+            if can_mask_fast(logits):
+                if is_capturing_graph(logits):
+                    raise RuntimeError(_GRAPH_CAPTURE_ERROR)
+                return mask_logits_fast(self, logits)
+        logits, ptr, size = convert_slice(logits)
+        _internal_mask_logits(self, ptr, size)
         return logits
     
     def update_logits(self, token_id:int, logits)->typing.Tuple[typing.Any,AcceptTokenResult]:
@@ -87,6 +385,8 @@ The logits will be updated in-place if:
     * The logits data type is `float32`.
     * The underlying data buffer are contiguous AND on CPU.
     * The data pointer is aligned to 4 bytes.
+A `torch.Tensor` that is not on CPU is updated in-place on its own device instead,
+which is not allowed during CUDA graph capture.
 
 # Returns
 
@@ -94,9 +394,26 @@ The logits will be updated in-place if:
     Otherwise, a new object with the same type as the input logits is returned. 
     The `result` is the result of accepting the token ID.
 """
-        logits, ptr, size = _convert_logits_to_slice(logits)
-        result = super().update_logits(token_id,ptr, size)
+        dispatch = _dispatch_cache.get(type(logits))
+        if dispatch is None:
+            dispatch = _resolve_dispatch(type(logits))
+        fast_path, convert_slice = dispatch
+        if fast_path is not None:
+            can_mask_fast, is_capturing_graph, mask_logits_fast = fast_path
+            # Otherwise a single engine call below accepts the token, computes and masks.
+            if can_mask_fast(logits):
+                # Checked before the token is accepted so that the engine is left untouched.
+                if is_capturing_graph(logits):
+                    raise RuntimeError(_GRAPH_CAPTURE_ERROR)
+                result = self.try_accept_new_token(token_id)
+                if result == AcceptTokenResult.Finished:
+                    return logits,result
+                self.compute_allowed_token_ids()
+                return mask_logits_fast(self, logits),result
+        logits, ptr, size = convert_slice(logits)
+        result = _internal_update_logits(self, token_id, ptr, size)
         return logits,result
 
 _try_register_slice_converter("torch", _torch_slice_converter)
-_try_register_slice_converter("numpy", _numpy_slice_converter)
\ No newline at end of file
+_try_register_slice_converter("numpy", _numpy_slice_converter)
+_try_register_fast_mask_logits("torch", _torch_fast_mask_logits)
\ No newline at end of file
@@ -1882,12 +1882,27 @@ where
     }
 
     fn mask_logits(&self, logits: &mut [f32]) -> Result<(), crate::engine_like::MaskLogitsError> {
-        if logits.len() != self.vocabulary.vocab_size() {
+        // The bitset is sized to the vocabulary on creation, and its length is O(1)
+        // while Vocabulary::vocab_size scans every token ID.
+        if logits.len() != self.allowed_token_ids.len() {
             return Err(crate::engine_like::MaskLogitsError::InvalidLogitsLength);
         }
-        for (token_id, logit) in logits.iter_mut().enumerate() {
-            if !self.allowed_token_ids.contains(token_id) {
-                *logit = f32::NEG_INFINITY;
+        const BITS: usize = usize::BITS as usize;
+        let blocks = self.allowed_token_ids.as_slice();
+        let number_of_full_chunks = logits.len() / BITS;
+        let mut chunks = logits.chunks_exact_mut(BITS);
+        utils::mask_full_logits_chunks(&mut chunks, blocks);
+        // The last chunk is partial when the vocabulary size is not a multiple of the block size.
+        if let Some(block) = blocks.get(number_of_full_chunks) {
+            let chunk = chunks.into_remainder();
+            let mut disallowed = !*block;
+            while disallowed != 0 {
+                match chunk.get_mut(disallowed.trailing_zeros() as usize) {
+                    Some(logit) => *logit = f32::NEG_INFINITY,
+                    // The padding bits of the last block
+                    None => break,
+                }
+                disallowed &= disallowed - 1;
             }
         }
         Ok(())
@@ -6,6 +6,8 @@ use crate::{AcceptTokenResult, Config, Engine, EngineLike, Token};
 use pyo3::exceptions::PyValueError;
 #[cfg(feature = "python")]
 use pyo3::{pymethods, PyErr};
+#[cfg(feature = "python")]
+use std::hash::{Hash, Hasher};
 #[cfg(feature = "wasm")]
 use wasm_bindgen::prelude::*;
 
@@ -613,6 +615,107 @@ impl Engine {
         let logits = std::slice::from_raw_parts_mut(logits_ptr as *mut f32, length);
         EngineLike::update_logits(self, token_id, logits)
     }
+
+    /// Gets a 64-bit fingerprint of the allowed token IDs since last computation.
+    /// Two computations that allow exactly the same token IDs yield equal fingerprints within the same process.
+    ///
+    /// # Signature
+    ///
+    /// (self) -> int
+    #[pyo3(name = "get_fingerprint_of_allowed_token_ids")]
+    pub fn fingerprint_of_allowed_token_ids_py(&self) -> u64 {
+        let mut hasher = ahash::AHasher::default();
+        EngineLike::allowed_token_ids_from_last_computation(self)
+            .as_slice()
+            .hash(&mut hasher);
+        hasher.finish()
+    }
+
+    /// Gets the number of allowed and disallowed token IDs since last computation in a single call.
+    /// Their sum is the vocabulary size.
+    ///
+    /// # Signature
+    ///
+    /// (self) -> tuple[int, int]
+    #[pyo3(name = "get_number_of_allowed_and_disallowed_token_ids")]
+    pub fn number_of_allowed_and_disallowed_token_ids_py(&self) -> (usize, usize) {
+        let ids = EngineLike::allowed_token_ids_from_last_computation(self);
+        let number_of_allowed = ids.count_ones(..);
+        (number_of_allowed, ids.len() - number_of_allowed)
+    }
+
+    /// Writes the allowed token IDs since last computation to the start of the given buffer
+    /// and the disallowed token IDs after them, both in ascending order.
+    ///
+    /// # Signature
+    ///
+    /// (self, buffer_ptr: int, length: int) -> int
+    ///
+    /// # Arguments
+    ///
+    /// * `buffer_ptr` - The pointer to the int64 buffer.
+    /// * `length` - The length of the buffer, which should be equal to the vocabulary size.
+    ///
+    /// # Returns
+    ///
+    /// * `usize` - The number of allowed token IDs, i.e. the offset of the first disallowed token ID in the buffer.
+    ///
+    /// # Errors
+    ///
+    /// Returns a [`MaskLogitsError`] when the buffer is not of the expected length according to the vocabulary.
+    /// The buffer is not updated in this case.
+    ///
+    /// # Safety
+    ///
+    /// The caller must ensure that the pointer is on CPU, points to writable, aligned memory that contains int64 and the length is correct.
+    #[pyo3(name = "write_allowed_and_disallowed_token_ids_to_buffer")]
+    pub unsafe fn write_allowed_and_disallowed_token_ids_to_buffer_py(
+        &self,
+        buffer_ptr: usize,
+        length: usize,
+    ) -> Result<usize, MaskLogitsError> {
+        let ids = EngineLike::allowed_token_ids_from_last_computation(self);
+        if length != ids.len() {
+            return Err(MaskLogitsError::InvalidLogitsLength);
+        }
+        let buffer = std::slice::from_raw_parts_mut(buffer_ptr as *mut i64, length);
+        Ok(crate::utils::write_ones_then_zeroes_to_buffer(ids, buffer))
+    }
+
+    /// Writes the allowed token IDs since last computation to the given buffer as a packed bitmask.
+    /// Bit `i % 64` of the `i / 64`-th int64 word is set if and only if token ID `i` is allowed.
+    ///
+    /// # Signature
+    ///
+    /// (self, buffer_ptr: int, vocab_size: int) -> None
+    ///
+    /// # Arguments
+    ///
+    /// * `buffer_ptr` - The pointer to the int64 buffer.
+    /// * `vocab_size` - The vocabulary size. The buffer must hold `ceil(vocab_size / 64)` int64 words.
+    ///
+    /// # Errors
+    ///
+    /// Returns a [`MaskLogitsError`] when `vocab_size` is not equal to the vocabulary size.
+    /// The buffer is not updated in this case.
+    ///
+    /// # Safety
+    ///
+    /// The caller must ensure that the pointer is on CPU, points to writable, aligned memory that contains int64 and the length is correct.
+    #[pyo3(name = "write_bitmask_to_buffer")]
+    pub unsafe fn write_bitmask_to_buffer_py(
+        &self,
+        buffer_ptr: usize,
+        vocab_size: usize,
+    ) -> Result<(), MaskLogitsError> {
+        let ids = EngineLike::allowed_token_ids_from_last_computation(self);
+        if vocab_size != ids.len() {
+            return Err(MaskLogitsError::InvalidLogitsLength);
+        }
+        let buffer = std::slice::from_raw_parts_mut(buffer_ptr as *mut u64, (vocab_size + 63) / 64);
+        crate::utils::write_blocks_to_words(ids.as_slice(), vocab_size, buffer);
+        Ok(())
+    }
 }
 
 #[cfg(feature = "wasm")]
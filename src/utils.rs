@@ -169,3 +169,120 @@ pub(crate) fn fill_debug_form_of_id_to_x<'a, T: std::fmt::Debug>(
 ) -> AHashMap<String, T> {
     id_to_x.enumerate().map(|(i, x)| (get_str(i), x)).collect()
 }
+
+/// Masks full chunks of logits, each paired with the bitset block of the same token IDs.
+/// When `select_dense` is true, blocks with many disallowed tokens use a branchless select,
+/// which only pays off when it compiles to SIMD blends.
+#[inline(always)]
+fn mask_full_logits_chunks_impl<'a>(
+    chunks: impl Iterator<Item = &'a mut [f32]>,
+    blocks: &[usize],
+    select_dense: bool,
+) {
+    const BITS: usize = usize::BITS as usize;
+    for (chunk, block) in chunks.zip(blocks) {
+        // The length is known at compile time, so fills are unrolled and stores need no bound check.
+        let chunk: &mut [f32; BITS] = chunk.try_into().unwrap();
+        let block = *block;
+        if block == 0 {
+            // The whole block is disallowed, so it is filled at once with vector stores.
+            chunk.fill(f32::NEG_INFINITY);
+        } else if select_dense && block.count_zeros() as usize > BITS / 8 {
+            for (i, logit) in chunk.iter_mut().enumerate() {
+                *logit = if block >> i & 1 == 0 {
+                    f32::NEG_INFINITY
+                } else {
+                    *logit
+                };
+            }
+        } else {
+            // Only the disallowed token IDs are visited, by walking the set bits of the inverted block.
+            // A fully allowed block inverts to zero and is skipped without touching the logits.
+            let mut disallowed = !block;
+            while disallowed != 0 {
+                chunk[disallowed.trailing_zeros() as usize] = f32::NEG_INFINITY;
+                disallowed &= disallowed - 1;
+            }
+        }
+    }
+}
+
+#[cfg(any(target_arch = "x86", target_arch = "x86_64"))]
+#[target_feature(enable = "avx2,bmi1,popcnt")]
+unsafe fn mask_full_logits_chunks_avx2<'a>(
+    chunks: impl Iterator<Item = &'a mut [f32]>,
+    blocks: &[usize],
+) {
+    mask_full_logits_chunks_impl(chunks, blocks, true)
+}
+
+/// Masks full chunks of `usize::BITS` logits, each paired with the bitset block of the same token IDs.
+/// A bit that is zero in the block sets the corresponding logit to negative infinity.
+pub(crate) fn mask_full_logits_chunks<'a>(
+    chunks: impl Iterator<Item = &'a mut [f32]>,
+    blocks: &[usize],
+) {
+    // Without wide variable shifts the select stays scalar and is much slower than the bit walk,
+    // so it is only enabled when the running CPU supports AVX2.
+    #[cfg(any(target_arch = "x86", target_arch = "x86_64"))]
+    if is_x86_feature_detected!("avx2")
+        && is_x86_feature_detected!("bmi1")
+        && is_x86_feature_detected!("popcnt")
+    {
+        // SAFETY: The running CPU supports AVX2, BMI1 and POPCNT.
+        unsafe { mask_full_logits_chunks_avx2(chunks, blocks) };
+        return;
+    }
+    mask_full_logits_chunks_impl(chunks, blocks, false)
+}
+
+/// Helper function to write the indices of the set bits of a bitset to the start of the buffer
+/// and the indices of the unset bits after them, both in ascending order.
+/// Returns the number of set bits, i.e. the offset of the first index of an unset bit in the buffer.
+///
+/// # Panics
+///
+/// Panics if the buffer length is not equal to the bitset length.
+pub fn write_ones_then_zeroes_to_buffer(
+    bitset: &fixedbitset_stack::FixedBitSet,
+    buffer: &mut [i64],
+) -> usize {
+    assert_eq!(buffer.len(), bitset.len());
+    let mut number_of_ones = 0;
+    for (slot, index) in buffer.iter_mut().zip(bitset.ones()) {
+        *slot = index as i64;
+        number_of_ones += 1;
+    }
+    for (slot, index) in buffer[number_of_ones..].iter_mut().zip(bitset.zeroes()) {
+        *slot = index as i64;
+    }
+    number_of_ones
+}
+
+/// Helper function to pack the blocks of a bitset of length `len` into 64-bit words.
+/// Bit `i % 64` of the `i / 64`-th word is set if and only if bit `i` is set in the bitset.
+/// Blocks narrower than 64 bits are packed several to a word, and the bits of the last word past `len` are cleared.
+///
+/// # Panics
+///
+/// Panics if `words` does not hold exactly `ceil(len / 64)` words or `blocks` cannot cover them.
+pub fn write_blocks_to_words<B: num::traits::AsPrimitive<u64>>(
+    blocks: &[B],
+    len: usize,
+    words: &mut [u64],
+) {
+    let block_bits = std::mem::size_of::<B>() * 8;
+    // One for usize blocks on 64-bit targets, where this is a plain copy of the blocks.
+    let blocks_per_word = u64::BITS as usize / block_bits;
+    assert_eq!(words.len(), (len + 63) / 64);
+    assert!(blocks.len() * block_bits >= len);
+    for (word, blocks) in words.iter_mut().zip(blocks.chunks(blocks_per_word)) {
+        *word = blocks
+            .iter()
+            .enumerate()
+            .fold(0, |word, (i, block)| word | block.as_() << (block_bits * i));
+    }
+    if len % 64 != 0 {
+        words[len / 64] &= (1 << (len % 64)) - 1;
+    }
+}
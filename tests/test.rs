@@ -436,4 +436,88 @@ mod tests {
             .unwrap();
         assert_eq!(result, AcceptTokenResult::Finished);
     }
+    #[test]
+    fn mask_logits_matches_allowed_token_ids() {
+        let vocab = read_rwkv_world_vocab("tests/rwkv_vocab_v20230424.json").unwrap();
+        // A grammar allowing almost nothing and one allowing almost everything
+        for input in ["start::='aaa';", "start::=#\".+\"'\n';"] {
+            let mut engine = kbnf::engine::Engine::new(input, vocab.clone()).unwrap();
+            engine.compute_allowed_token_ids();
+            let mut logits = vec![0.0; vocab.vocab_size()];
+            assert_eq!(
+                engine.mask_logits(&mut logits[1..]),
+                Err(kbnf::engine_like::MaskLogitsError::InvalidLogitsLength)
+            );
+            engine.mask_logits(logits.as_mut_slice()).unwrap();
+            let allowed_token_ids = engine.allowed_token_ids_from_last_computation();
+            for (token_id, logit) in logits.iter().enumerate() {
+                assert_eq!(
+                    allowed_token_ids.contains(token_id),
+                    *logit == 0.0,
+                    "Token ID {} is masked incorrectly",
+                    token_id
+                );
+            }
+        }
+    }
+    #[test]
+    fn write_ones_then_zeroes_to_buffer_matches_allowed_token_ids() {
+        let vocab = read_rwkv_world_vocab("tests/rwkv_vocab_v20230424.json").unwrap();
+        // A grammar allowing almost nothing and one allowing almost everything
+        for input in ["start::='aaa';", "start::=#\".+\"'\n';"] {
+            let mut engine = kbnf::engine::Engine::new(input, vocab.clone()).unwrap();
+            engine.compute_allowed_token_ids();
+            let allowed_token_ids = engine.allowed_token_ids_from_last_computation();
+            let mut buffer = vec![-1; vocab.vocab_size()];
+            let number_of_allowed =
+                kbnf::utils::write_ones_then_zeroes_to_buffer(allowed_token_ids, &mut buffer);
+            assert_eq!(number_of_allowed, allowed_token_ids.count_ones(..));
+            let (allowed, disallowed) = buffer.split_at(number_of_allowed);
+            // Both parts are strictly ascending, so together they cover every token ID exactly once.
+            assert!(allowed.windows(2).all(|w| w[0] < w[1]));
+            assert!(disallowed.windows(2).all(|w| w[0] < w[1]));
+            for token_id in allowed {
+                assert!(allowed_token_ids.contains(*token_id as usize));
+            }
+            for token_id in disallowed {
+                assert!((*token_id as usize) < vocab.vocab_size());
+                assert!(!allowed_token_ids.contains(*token_id as usize));
+            }
+        }
+    }
+    #[test]
+    fn write_blocks_to_words_matches_allowed_token_ids() {
+        let vocab = read_rwkv_world_vocab("tests/rwkv_vocab_v20230424.json").unwrap();
+        // A grammar allowing almost nothing and one allowing almost everything
+        for input in ["start::='aaa';", "start::=#\".+\"'\n';"] {
+            let mut engine = kbnf::engine::Engine::new(input, vocab.clone()).unwrap();
+            engine.compute_allowed_token_ids();
+            let allowed_token_ids = engine.allowed_token_ids_from_last_computation();
+            let blocks = allowed_token_ids.as_slice();
+            // 32-bit blocks are packed two to a word, as usize blocks are on 32-bit targets.
+            let narrow_blocks: Vec<u32> = blocks
+                .iter()
+                .flat_map(|block| (0..usize::BITS / 32).map(move |i| (*block >> (32 * i)) as u32))
+                .collect();
+            // A shorter length leaves padding bits in the last word, which must be cleared.
+            for len in [allowed_token_ids.len(), allowed_token_ids.len() - 5] {
+                let mut words = vec![u64::MAX; (len + 63) / 64];
+                let mut narrow_words = vec![u64::MAX; (len + 63) / 64];
+                kbnf::utils::write_blocks_to_words(blocks, len, &mut words);
+                kbnf::utils::write_blocks_to_words(&narrow_blocks, len, &mut narrow_words);
+                assert_eq!(words, narrow_words);
+                for (i, word) in words.iter().enumerate() {
+                    for bit in 0..64 {
+                        let token_id = i * 64 + bit;
+                        assert_eq!(
+                            word >> bit & 1 == 1,
+                            token_id < len && allowed_token_ids.contains(token_id),
+                            "Token ID {} is packed incorrectly",
+                            token_id
+                        );
+                    }
+                }
+            }
+        }
+    }
 }